@@ -3,23 +3,116 @@
 """Scrapes Steam reviews for a user."""
 
 import argparse
+import random
 import re
-import urllib.request
 import os.path
+import threading
 import time
-import json
+from datetime import datetime
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache
+import numpy as np
+import orjson
 import requests
-from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
+from bs4 import BeautifulSoup, SoupStrainer
+import lxml.html
+from lxml import etree
 from markdownify import markdownify as md
 from dateutil import parser
 
 CACHE_FILE = '/tmp/appnames.json'
+NAME_IDS_FILE = CACHE_FILE + '.ids.npy'
+NAME_NAMES_FILE = CACHE_FILE + '.names.json'
+CACHE_META_FILE = CACHE_FILE + '.meta'
+
+_APP_NAME_MAP = None
+_APP_NAME_LOCK = threading.Lock()
+
+MAX_WORKERS = 8
+DEFAULT_MAX_CONCURRENCY = 4
+DEFAULT_MIN_DELAY = 0.1
+DEFAULT_MAX_DELAY = 0.5
+
+DATE_FORMATS = ("%d %B, %Y", "%B %d, %Y")
+
+REVIEW_COUNT_REGEX = re.compile(r"Showing [\d,]+-[\d,]+ of (?P<total>[\d,]+) entries")
+REVIEW_DATE_REGEX = re.compile(
+    r"Posted (?P<review_date>.*?)\.(\s*Last edited (?P<last_updated>.*?)\.)?")
+PLAYTIME_REGEX = re.compile(
+    r"(?P<total_playtime>.*?) hrs on record(\s*\((?P<playtime_at_review>.*?) hrs at review time\))?")
+
+
+def _has_class(name):
+    """Builds an XPath predicate matching elements that carry the given CSS class."""
+    return f"contains(concat(' ', normalize-space(@class), ' '), ' {name} ')"
+
+
+_XP_REVIEWS = etree.XPath(f"//div[{_has_class('review_box')}]")
+_XP_PAGING_TEXT = etree.XPath("//text()[contains(., ' entries')]")
+_XP_LINK = etree.XPath(f".//a[{_has_class('game_capsule_ctn')}]/@href")
+_XP_CONTENT = etree.XPath(f".//div[{_has_class('content')}]")
+_XP_POSTED = etree.XPath(f"string(.//div[{_has_class('posted')}])")
+_XP_HOURS = etree.XPath(f"string(.//div[{_has_class('hours')}])")
+
+SESSION = requests.Session()
+SESSION.headers['User-Agent'] = 'archive-steam-reviews'
+_ADAPTER = HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=20,
+    max_retries=Retry(
+        total=3,
+        backoff_factor=2,
+        status_forcelist=[429, 500, 502, 503, 504]))
+SESSION.mount('https://', _ADAPTER)
+SESSION.mount('http://', _ADAPTER)
+
+
+class Throttle:
+    """Limits the number of concurrent requests per host and pauses after each request."""
+
+    def __init__(self, max_concurrency, min_delay, max_delay):
+        self._lock = threading.Lock()
+        self.configure(max_concurrency, min_delay, max_delay)
+
+    def configure(self, max_concurrency, min_delay, max_delay):
+        """Sets new limits, dropping any per-host semaphores created with the old ones."""
+        with self._lock:
+            self.max_concurrency = max_concurrency
+            self.min_delay = min_delay
+            self.max_delay = max_delay
+            self._semaphores = {}
+
+    def host_semaphore(self, url):
+        """Returns the semaphore limiting concurrent requests to the host of a URL."""
+        host = urllib.parse.urlsplit(url).netloc
+        with self._lock:
+            if host not in self._semaphores:
+                self._semaphores[host] = threading.Semaphore(self.max_concurrency)
+            return self._semaphores[host]
+
+    def pause(self):
+        """Sleeps for a random delay between the configured bounds."""
+        time.sleep(random.uniform(self.min_delay, self.max_delay))
+
+
+THROTTLE = Throttle(DEFAULT_MAX_CONCURRENCY, DEFAULT_MIN_DELAY, DEFAULT_MAX_DELAY)
+
+
+def polite_get(url, **kwargs):
+    """GETs a URL via the shared session, limiting concurrency per host and pausing afterwards."""
+    with THROTTLE.host_semaphore(url):
+        try:
+            return SESSION.get(url, **kwargs)
+        finally:
+            THROTTLE.pause()
 
 
 def is_older_than(file, days=1):
     """Checks if a file was modified within the last x days."""
-    file_time = os.path.getmtime(file)
-    return (time.time() - file_time) / 3600 > 24 * days
+    return time.time() - os.stat(file).st_mtime > days * 86400
 
 
 def cache_app_names():
@@ -28,16 +121,47 @@ def cache_app_names():
 
     if not os.path.isfile(CACHE_FILE) or is_older_than(CACHE_FILE, 7):
         print("Refreshing app name cache (" + CACHE_FILE + ").")
-        urllib.request.urlretrieve(source_url, CACHE_FILE)
-
-
+        headers = {'Accept-Encoding': 'gzip, deflate'}
+        if os.path.isfile(CACHE_FILE) and os.path.isfile(CACHE_META_FILE):
+            with open(CACHE_META_FILE, mode='rb') as f:
+                meta = orjson.loads(f.read())
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+
+        with polite_get(source_url, stream=True, timeout=30, headers=headers) as response:
+            if response.status_code == 304:
+                # Unchanged upstream, just mark the cache (and the name map built from it) as fresh
+                os.utime(CACHE_FILE, None)
+                for name_map_file in (NAME_IDS_FILE, NAME_NAMES_FILE):
+                    if os.path.isfile(name_map_file):
+                        os.utime(name_map_file, None)
+                return
+
+            response.raise_for_status()
+            with open(CACHE_FILE, mode='wb') as f:
+                for chunk in response.iter_content(chunk_size=64 * 1024):
+                    f.write(chunk)
+
+        with open(CACHE_META_FILE, mode='wb') as f:
+            f.write(orjson.dumps({
+                'etag': response.headers.get('ETag'),
+                'last_modified': response.headers.get('Last-Modified')}))
+        build_app_name_map()
+
+
+@lru_cache(maxsize=None)
 def fallback_name_by_id_lookup(app_id):
     """Scrapes a game name from the corresponding store page."""
     name = 'unknown'
 
     url = 'https://store.steampowered.com/app/' + str(app_id)
-    response = requests.get(url, timeout=10)
-    soup = BeautifulSoup(response.content, "html.parser")
+    response = polite_get(url, timeout=10)
+    soup = BeautifulSoup(
+        response.content,
+        "lxml",
+        parse_only=SoupStrainer("div", id="appHubAppName_responsive"))
     name_div = soup.find("div", id="appHubAppName_responsive")
 
     if name_div:
@@ -46,58 +170,126 @@ def fallback_name_by_id_lookup(app_id):
     return name
 
 
+def build_app_name_map():
+    """Parses the cached app list JSON into sorted appid and appname lists and stores them next to it."""
+    with open(CACHE_FILE, mode='rb') as f:
+        apps = orjson.loads(f.read())['applist']['apps']
+
+    app_ids = np.array([app['appid'] for app in apps], dtype=np.int64)
+    order = np.argsort(app_ids, kind='stable')
+    app_ids = app_ids[order]
+    names = [apps[i]['name'] for i in order]
+
+    # Plain data formats only, loading these must never be able to execute code
+    with open(NAME_IDS_FILE, mode='wb') as f:
+        np.save(f, app_ids, allow_pickle=False)
+    with open(NAME_NAMES_FILE, mode='wb') as f:
+        f.write(orjson.dumps(names))
+
+    return app_ids, names
+
+
+def read_app_name_map():
+    """Reads the stored appid and appname lists, or returns None if they are missing or outdated."""
+    for name_map_file in (NAME_IDS_FILE, NAME_NAMES_FILE):
+        if not os.path.isfile(name_map_file) or \
+                os.path.getmtime(name_map_file) < os.path.getmtime(CACHE_FILE):
+            return None
+
+    try:
+        app_ids = np.load(NAME_IDS_FILE, allow_pickle=False)
+        with open(NAME_NAMES_FILE, mode='rb') as f:
+            names = orjson.loads(f.read())
+    except (OSError, ValueError):
+        return None
+
+    if app_ids.ndim != 1 or not isinstance(names, list) or len(app_ids) != len(names):
+        return None
+
+    return app_ids, names
+
+
+def load_app_names():
+    """Returns the cached (appids, appnames) lists, reading them from disk on first use."""
+    global _APP_NAME_MAP  # pylint: disable=global-statement
+
+    with _APP_NAME_LOCK:
+        if _APP_NAME_MAP is None:
+            _APP_NAME_MAP = read_app_name_map() or build_app_name_map()
+
+    return _APP_NAME_MAP
+
+
 def find_name_by_id(app_id):
     """Returns the game name for a given app_id, either from local cache or new scrape."""
-    name = 'unknown'
-    with open(CACHE_FILE, encoding="utf-8") as f:
-        apps = json.load(f)['applist']['apps']
-        for app in apps:
-            if app['appid'] == app_id:
-                name = app['name']
-                break
+    app_ids, names = load_app_names()
+    i = np.searchsorted(app_ids, app_id)
 
-    if name == 'unknown':
-        name = fallback_name_by_id_lookup(app_id)
+    if i < len(app_ids) and app_ids[i] == app_id:
+        return names[i]
 
-    return name
+    return fallback_name_by_id_lookup(app_id)
 
 
 def parse_review_dates(review):
     """Extracts the date a review was published and last updated."""
-    review_date_text = review.find("div", class_="posted").text.strip()
-    review_date_regex = r"Posted (?P<review_date>.*?)\.(\s*Last edited (?P<last_updated>.*?)\.)?"
-    matches = re.finditer(review_date_regex, review_date_text)
-    review_date = None
-    last_updated = None
-    for m in matches:
-        review_date = m.group('review_date')
-        last_updated = m.group('last_updated')
+    review_date_text = _XP_POSTED(review).strip()
+    m = REVIEW_DATE_REGEX.search(review_date_text)
+    if not m:
+        return None, None
+
+    return m.group('review_date'), m.group('last_updated')
+
 
-    return review_date, last_updated
+def parse_steam_date(date_text):
+    """Parses a date as shown on Steam, falling back to dateutil for unknown formats."""
+    for date_format in DATE_FORMATS:
+        # Steam leaves out the year for dates in the current year
+        for text in (date_text, date_text + ', ' + str(datetime.now().year)):
+            try:
+                return datetime.strptime(text, date_format)
+            except ValueError:
+                pass
+
+    return parser.parse(date_text)
 
 
 def parse_review_playtime(review):
     """Extracts the current total and "total at time of review" playtime."""
-    playtime_text = review.find("div", class_="hours").text.strip()
-    playtime_regex = r"(?P<total_playtime>.*?) hrs on record(\s*\((?P<playtime_at_review>.*?) hrs at review time\))?"
-    matches = re.finditer(playtime_regex, playtime_text)
-    total_playtime = None
-    playtime_at_review = None
-    for m in matches:
-        total_playtime = m.group('total_playtime')
-        playtime_at_review = m.group('playtime_at_review')
-    return total_playtime, playtime_at_review
+    playtime_text = _XP_HOURS(review).strip()
+    m = PLAYTIME_REGEX.search(playtime_text)
+    if not m:
+        return None, None
+
+    return m.group('total_playtime'), m.group('playtime_at_review')
+
+
+def inner_html(element):
+    """Serializes the children of an lxml element, without the element's own tag."""
+    return (element.text or '') + ''.join(
+        etree.tostring(child, encoding='unicode', method='html') for child in element)
+
+
+def review_steam_id(review):
+    """Extracts the app id a review is for from its store link."""
+    return int(_XP_LINK(review)[0].split('/')[-1])
+
+
+def review_file_name(steam_id):
+    """Returns the name of the Markdown file a review is saved to."""
+    return str(steam_id) + '.md'
+
+
+def is_archived(review):
+    """Checks if a review has already been saved to the filesystem."""
+    return os.path.isfile(review_file_name(review_steam_id(review)))
 
 
 def parse_review(review, username):
     """Extracts all relevant raw data for a review."""
-    steam_link = review.find("a", class_="game_capsule_ctn")["href"]
-    steam_id = int(steam_link.split('/')[-1])
+    steam_id = review_steam_id(review)
 
-    review_text = md(
-        review.find(
-            "div",
-            class_="content").decode_contents())
+    review_text = md(inner_html(_XP_CONTENT(review)[0]))
 
     review_date, last_updated = parse_review_dates(review)
     total_playtime, playtime_at_review = parse_review_playtime(review)
@@ -110,36 +302,84 @@ def parse_review(review, username):
         "total_playtime": total_playtime,
         "playtime_at_review": playtime_at_review,
         "review_text": review_text,
-        "review_date": parser.parse(review_date),
+        "review_date": parse_steam_date(review_date),
         "last_updated": None if not last_updated or (
-            last_updated == review_date) else parser.parse(last_updated)}
+            last_updated == review_date) else parse_steam_date(last_updated)}
 
 
-def scrape_steam_reviews(username, download_all):
-    """Scrapes Steam reviews for a given username."""
-    base_url = f"https://steamcommunity.com/id/{username}/recommended/?p="
-    page_number = 1
-    parsed_reviews = []
+def fetch_review_page(url):
+    """Downloads a review page and returns its document tree and review boxes."""
+    response = polite_get(url, timeout=10)
+    document = lxml.html.fromstring(response.content)
+    return document, _XP_REVIEWS(document)
 
-    while True:
-        url = base_url + str(page_number)
-        response = requests.get(url, timeout=10)
-        soup = BeautifulSoup(response.content, "html.parser")
-        reviews = soup.find_all("div", class_="review_box")
 
-        # TODO: Proper check based on " Showing 1-10 of 55 entries " text
-        if not reviews:
-            break
+def count_review_pages(document, per_page):
+    """Derives the number of review pages from the " Showing 1-10 of 55 entries " text."""
+    for paging_text in _XP_PAGING_TEXT(document):
+        match = REVIEW_COUNT_REGEX.search(paging_text)
+        if match:
+            total = int(match.group('total').replace(',', ''))
+            return -(-total // per_page)
 
-        for review in reviews:
-            parsed_reviews.append(parse_review(review, username))
+    return None
 
-        if download_all:
-            page_number += 1
+
+def scrape_steam_reviews(username, download_all, skip_archived=False):
+    """Scrapes Steam reviews for a given username."""
+    base_url = f"https://steamcommunity.com/id/{username}/recommended/?p="
+
+    document, first_page = fetch_review_page(base_url + '1')
+    per_page = len(first_page)
+
+    if skip_archived:
+        # Drop already saved reviews before any of the expensive parsing happens
+        first_page = [review for review in first_page if not is_archived(review)]
+        # Reviews are sorted by most recently changed, so if the whole first page
+        # is already archived, the following pages will be as well
+        if not first_page:
+            download_all = False
+
+    num_pages = 1
+    if per_page and download_all:
+        num_pages = count_review_pages(document, per_page)
+
+    # Pages are downloaded in their own pool (sized to the per-host limit, so
+    # no worker just waits for the throttle) and each page's reviews are handed
+    # to the parsing pool, which may need store page lookups for app names, as
+    # soon as that page arrives
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as parse_executor, \
+            ThreadPoolExecutor(max_workers=THROTTLE.max_concurrency) as fetch_executor:
+        def submit_parsing(reviews):
+            return [
+                parse_executor.submit(parse_review, review, username)
+                for review in reviews
+                if not (skip_archived and is_archived(review))]
+
+        parsed_pages = {
+            1: [parse_executor.submit(parse_review, review, username) for review in first_page]}
+
+        if num_pages is None:
+            # Paging info missing, walk the pages one by one until they run out
+            page_number = 2
+            while True:
+                _, reviews = fetch_review_page(base_url + str(page_number))
+                if not reviews:
+                    break
+                parsed_pages[page_number] = submit_parsing(reviews)
+                page_number += 1
         else:
-            break
+            fetches = {
+                fetch_executor.submit(fetch_review_page, base_url + str(page_number)): page_number
+                for page_number in range(2, num_pages + 1)}
+            for fetch in as_completed(fetches):
+                _, reviews = fetch.result()
+                parsed_pages[fetches[fetch]] = submit_parsing(reviews)
 
-    return parsed_reviews
+        return [
+            review.result()
+            for page_number in sorted(parsed_pages)
+            for review in parsed_pages[page_number]]
 
 
 def print_review(review):
@@ -158,31 +398,38 @@ def save_review(review):
     """Saves a parsed review into a Hugo-compatible Markdown file."""
     steam_id = review['steam_link'].split('/')[-1]
 
-    with open(steam_id + '.md', mode='w', encoding="utf-8") as f:
-        f.write('---')
-        f.write('\n')
-        f.write('title: "' + review['app_name'] + '"')
-        f.write('\n')
-        f.write('steam_link: ' + review['steam_link'])
-        f.write('\n')
-        f.write('review_link: ' + review['review_link'])
-        f.write('\n')
-        f.write('date: ' + review['review_date'].strftime("%Y-%m-%d"))
-        if review['last_updated']:
-            f.write('\n')
-            f.write(
-                'last_updated: ' +
-                review['last_updated'].strftime("%Y-%m-%d"))
-        f.write('\n')
-        f.write('total_playtime: ' + review['total_playtime'])
-        if review['playtime_at_review']:
-            f.write('\n')
-            f.write('playtime_at_review: ' + review['playtime_at_review'])
-        f.write('\n')
-        f.write('---')
-        f.write('\n')
-        f.write(review['review_text'])
-        f.write('\n')
+    parts = [
+        '---\n',
+        'title: "' + review['app_name'] + '"\n',
+        'steam_link: ' + review['steam_link'] + '\n',
+        'review_link: ' + review['review_link'] + '\n',
+        'date: ' + review['review_date'].strftime("%Y-%m-%d") + '\n']
+    if review['last_updated']:
+        parts.append('last_updated: ' + review['last_updated'].strftime("%Y-%m-%d") + '\n')
+    parts.append('total_playtime: ' + review['total_playtime'] + '\n')
+    if review['playtime_at_review']:
+        parts.append('playtime_at_review: ' + review['playtime_at_review'] + '\n')
+    parts.append('---\n')
+    parts.append(review['review_text'] + '\n')
+
+    with open(review_file_name(steam_id), mode='w', encoding="utf-8") as f:
+        f.write(''.join(parts))
+
+
+def positive_int(value):
+    """Argument type for integers that must be at least 1."""
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {value}")
+    return number
+
+
+def non_negative_float(value):
+    """Argument type for floats that must not be negative."""
+    number = float(value)
+    if number < 0:
+        raise argparse.ArgumentTypeError(f"must not be negative, got {value}")
+    return number
 
 
 def main():
@@ -202,11 +449,37 @@ def main():
         default=False,
         action='store_true',
         help="save downloaded reviews to filesystem (or print to stdout)")
+    arg_parser.add_argument(
+        '--force',
+        default=False,
+        action='store_true',
+        help="with --save, also overwrite reviews that were already saved before")
+    arg_parser.add_argument(
+        '--max-concurrency',
+        type=positive_int,
+        default=DEFAULT_MAX_CONCURRENCY,
+        help="maximum number of simultaneous requests per host")
+    arg_parser.add_argument(
+        '--min-delay',
+        type=non_negative_float,
+        default=DEFAULT_MIN_DELAY,
+        help="minimum pause in seconds after each request")
+    arg_parser.add_argument(
+        '--max-delay',
+        type=non_negative_float,
+        default=DEFAULT_MAX_DELAY,
+        help="maximum pause in seconds after each request")
     args = arg_parser.parse_args()
+    if args.min_delay > args.max_delay:
+        arg_parser.error("--min-delay must not be larger than --max-delay")
+
+    THROTTLE.configure(args.max_concurrency, args.min_delay, args.max_delay)
 
-    cache_app_names()
+    with SESSION:
+        cache_app_names()
 
-    reviews = scrape_steam_reviews(args.username, args.all)
+        reviews = scrape_steam_reviews(
+            args.username, args.all, args.save and not args.force)
 
     for review in reviews:
         if args.save: